@@ -1,4 +1,5 @@
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from models import SmartBlock
 from spark_core import SparkEngine
 import os
@@ -6,19 +7,46 @@ import os
 # --- 页面配置 ---
 st.set_page_config(page_title="Spark v2.0", page_icon="✨", layout="wide", initial_sidebar_state="expanded")
 
+# --- 缓存: Streamlit 每次交互都会从头重跑脚本 ---
+@st.cache_resource
+def get_engine():
+    return SparkEngine()
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=64)
+def cached_related(block_ids, revision, _engine):
+    """当前页所有片段的关联结果一次批量算出；
+    revision 取引擎中的向量数，有新片段入库时缓存自动失效"""
+    blocks = [_engine.by_id[block_id] for block_id in block_ids if block_id in _engine.by_id]
+    related = _engine.find_related_all(blocks)
+    return {block_id: [(r_block.id, score) for r_block, score in items] for block_id, items in related.items()}
+
 # --- 初始化 ---
-if 'engine' not in st.session_state:
-    if not os.getenv("GOOGLE_API_KEY"):
-        # 为了方便本地测试，如果环境变量没设，尝试读取 secrets (云端模式)
-        if "GOOGLE_API_KEY" in st.secrets:
-            os.environ["GOOGLE_API_KEY"] = st.secrets["GOOGLE_API_KEY"]
-        else:
-            st.error("⚠️ 未检测到 API Key！")
-            st.stop()
-    st.session_state.engine = SparkEngine()
+if not os.getenv("GOOGLE_API_KEY"):
+    # 为了方便本地测试，如果环境变量没设，尝试读取 secrets (云端模式)
+    if "GOOGLE_API_KEY" in st.secrets:
+        os.environ["GOOGLE_API_KEY"] = st.secrets["GOOGLE_API_KEY"]
+    else:
+        st.error("⚠️ 未检测到 API Key！")
+        st.stop()
+engine = get_engine()
 
 if 'blocks' not in st.session_state:
-    st.session_state.blocks = []
+    # 引擎会从磁盘恢复之前处理过的片段，最新的排在最前
+    st.session_state.blocks = engine.database[::-1]
+
+# 处理放到后台线程，页面不再被几十秒的 LLM 调用卡住
+if 'executor' not in st.session_state:
+    st.session_state.executor = ThreadPoolExecutor(max_workers=4)
+if 'pending' not in st.session_state:
+    st.session_state.pending = {}  # block.id -> Future
+
+# 每页只完整渲染这么多片段，避免片段多了以后每次重跑都渲染全部
+PAGE_SIZE = 10
+if 'page' not in st.session_state:
+    st.session_state.page = 0
+
+def goto_page(page):
+    st.session_state.page = page
 
 # --- 侧边栏：输入区 ---
 with st.sidebar:
@@ -62,7 +90,7 @@ with st.sidebar:
                 st.warning("请输入 YouTube 链接")
             else:
                 process_flag = True
-                content_payload = "Waiting for fetch..." # 占位符
+                content_payload = url_input
                 meta_data = {"url": url_input}
                 if use_time_range:
                     meta_data.update({"start_min": start_min, "end_min": end_min})
@@ -74,14 +102,32 @@ with st.sidebar:
                 content_payload = raw_text
 
         if process_flag:
-            with st.spinner("AI 正在抓取字幕、阅读、清洗、关联..."):
-                # 创建块
-                new_block = SmartBlock(source_type=source_type, raw_content=content_payload, metadata=meta_data)
-                # 处理
-                st.session_state.engine.process_block(new_block)
-                # 更新
-                st.session_state.blocks.insert(0, new_block)
-                st.success("完成！")
+            # 创建块
+            new_block = SmartBlock(source_type=source_type, raw_content=content_payload, metadata=meta_data)
+            # 提交到后台处理
+            future = st.session_state.executor.submit(engine.process_block, new_block)
+            st.session_state.pending[new_block.id] = future
+            # 更新
+            st.session_state.blocks.insert(0, new_block)
+            st.session_state.page = 0
+            st.success("已加入处理队列")
+
+# --- 后台任务轮询: 有任务完成时整页重跑 ---
+@st.fragment(run_every=2)
+def watch_pending():
+    pending = st.session_state.pending
+    finished = [block_id for block_id, future in pending.items() if future.done()]
+    if not finished:
+        return
+    for block_id in finished:
+        error = pending.pop(block_id).exception()
+        if error:
+            block = next(b for b in st.session_state.blocks if b.id == block_id)
+            block.processed_content = f"❌ 处理失败: {error}"
+    st.rerun()
+
+if st.session_state.pending:
+    watch_pending()
 
 # --- 主界面 ---
 st.title("✨ Spark v2.0 知识内化引擎")
@@ -90,20 +136,19 @@ st.markdown("---")
 if not st.session_state.blocks:
     st.info("👈 请在左侧输入 YouTube 链接或群聊记录，开始体验。")
 
-for block in st.session_state.blocks:
+page_count = max(1, -(-len(st.session_state.blocks) // PAGE_SIZE))
+page = min(st.session_state.page, page_count - 1)
+visible_blocks = st.session_state.blocks[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+related_map = cached_related(
+    tuple(b.id for b in visible_blocks if b.id not in st.session_state.pending), engine.emb_count, engine
+)
+
+for block in visible_blocks:
+    is_pending = block.id in st.session_state.pending
     col1, col2 = st.columns([7, 3])
     
     with col1:
-        # 标题处理
-        title = "未命名片段"
-        if block.processed_content and not block.processed_content.startswith("❌"):
-            lines = block.processed_content.splitlines()
-            for line in lines:
-                if line.strip().startswith("#"):
-                    title = line.strip("# ")
-                    break
-        
-        st.markdown(f"### {title}")
+        st.markdown(f"### {block.title or '未命名片段'}")
         
         # 元数据显示
         src_label = block.source_type
@@ -112,20 +157,24 @@ for block in st.session_state.blocks:
             src_label = f"[YouTube]({url})"
         
         st.caption(f"ID: {block.id[:6]} | 来源: {src_label} | 📅 {block.created_at.strftime('%H:%M')}")
-        
-        # 标签
-        if block.ai_tags:
-            st.markdown(" ".join([f"`{t}`" for t in block.ai_tags]))
-        
-        # 内容
-        with st.expander("📖 深度阅读", expanded=True):
-            st.markdown(block.processed_content)
+
+        if is_pending:
+            st.info("⏳ AI 正在抓取字幕、阅读、清洗、关联...")
+        else:
+            # 标签
+            if block.ai_tags:
+                st.markdown(" ".join([f"`{t}`" for t in block.ai_tags]))
+            
+            # 内容
+            with st.expander("📖 深度阅读", expanded=True):
+                st.markdown(block.processed_content)
 
     with col2:
         st.markdown("#### 🔗 关联实验室")
-        related = st.session_state.engine.find_related(block)
+        related = related_map.get(block.id, [])
         if related:
-            for r_block, score in related:
+            for r_id, score in related:
+                r_block = engine.by_id[r_id]
                 with st.container(border=True):
                     st.markdown(f"**关联度: {score:.0%}**")
                     st.caption(f"ID: {r_block.id[:6]}")
@@ -134,4 +183,14 @@ for block in st.session_state.blocks:
         else:
             st.markdown("*暂无强关联*")
     
-    st.markdown("---")
\ No newline at end of file
+    st.markdown("---")
+
+# --- 翻页 ---
+if page_count > 1:
+    col_prev, col_info, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        st.button("⬅️ 上一页", disabled=page == 0, on_click=goto_page, args=(page - 1,))
+    with col_info:
+        st.caption(f"第 {page + 1} / {page_count} 页 · 共 {len(st.session_state.blocks)} 个片段")
+    with col_next:
+        st.button("下一页 ➡️", disabled=page >= page_count - 1, on_click=goto_page, args=(page + 1,))
\ No newline at end of file
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+
+# 本地缓存目录 (可用环境变量覆盖)
+CACHE_DIR = os.path.expanduser(os.getenv("SPARK_CACHE_DIR", "~/.cache/spark"))
+
+
+class EmbeddingCache:
+    """以内容 SHA-256 为键的持久化向量缓存，命中时不再请求 Gemini"""
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "embeddings.db")
+        # Streamlit 会在不同线程里重跑脚本，连接需跨线程共享，由锁串行化
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vec BLOB)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{text}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute("SELECT vec FROM embeddings WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def put(self, key: str, embedding: List[float]):
+        blob = np.asarray(embedding, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO embeddings (hash, vec) VALUES (?, ?)", (key, blob))
+            self._conn.commit()
+
+
+class TranscriptCache:
+    """字幕的磁盘缓存: 每个视频 (+语言列表) 一个 JSON 文件。
+    确认没有字幕的视频也记一笔，短时间内不再重复请求"""
+
+    NEGATIVE_TTL = 3600
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.path.join(CACHE_DIR, "transcripts")
+
+    def _path(self, video_id: str, languages: List[str]) -> str:
+        key = hashlib.blake2b(f"{video_id}:{','.join(languages)}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, video_id: str, languages: List[str]) -> Optional[dict]:
+        """命中时返回 {"items": [...]} 或 {"error": ..., "at": ...}；未命中或负缓存过期返回 None"""
+        try:
+            with open(self._path(video_id, languages), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if "error" in entry and time.time() - entry.get("at", 0) > self.NEGATIVE_TTL:
+            return None
+        return entry
+
+    def put(self, video_id: str, languages: List[str], items: List[dict]):
+        self._write(video_id, languages, {"items": items})
+
+    def put_error(self, video_id: str, languages: List[str], error: str):
+        self._write(video_id, languages, {"error": error, "at": time.time()})
+
+    def _write(self, video_id: str, languages: List[str], entry: dict):
+        # 先写临时文件再改名，并发读到的总是完整文件
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(video_id, languages)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+class PromptCache:
+    """两级 LLM 结果缓存 (内存，LRU)：先按输入哈希精确匹配，
+    未命中再找向量余弦相似度超过阈值、且长度相近的近似输入"""
+
+    def __init__(self, max_entries: int = 256, threshold: float = 0.95, length_ratio: float = 0.9):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.length_ratio = length_ratio
+        self._lock = threading.Lock()
+        # key -> (归一化向量或 None, 输入长度, 结果)
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        # 语义检索用的矩阵，条目变动后惰性重建
+        self._matrix = None
+        self._matrix_lengths = None
+        self._matrix_keys: List[bytes] = []
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode()).digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def get_similar(self, embedding: List[float], length: int) -> Optional[str]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) + 1e-9
+        with self._lock:
+            if self._matrix is None:
+                self._matrix_keys = [k for k, (vec, _, _) in self._entries.items() if vec is not None]
+                if not self._matrix_keys:
+                    return None
+                self._matrix = np.stack([self._entries[k][0] for k in self._matrix_keys])
+                self._matrix_lengths = np.array([self._entries[k][1] for k in self._matrix_keys])
+            sims = self._matrix @ query
+            # 长度差太多的输入内容必然不同，即使向量相近也不算命中
+            ratio = np.minimum(self._matrix_lengths, length) / np.maximum(np.maximum(self._matrix_lengths, length), 1)
+            sims[ratio < self.length_ratio] = -np.inf
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            key = self._matrix_keys[best]
+            self._entries.move_to_end(key)
+            return self._entries[key][2]
+
+    def put(self, key: bytes, embedding: Optional[List[float]], length: int, response: str):
+        vec = None
+        if embedding:
+            vec = np.asarray(embedding, dtype=np.float32)
+            vec /= np.linalg.norm(vec) + 1e-9
+        with self._lock:
+            self._entries[key] = (vec, length, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
@@ -2,7 +2,8 @@ from models import SmartBlock
 from spark_core import SparkEngine
 
 def main():
-    engine = SparkEngine()
+    # 演示脚本不读写本地数据库
+    engine = SparkEngine(data_dir=None)
 
     # --- 模拟输入数据 ---
     
@@ -32,8 +33,7 @@ def main():
     # --- Step 1: 运行 AI 引擎处理 ---
     print("🚀 启动 Spark v2.0 引擎...")
     
-    engine.process_block(video_block)
-    engine.process_block(chat_block)
+    engine.process_blocks([video_block, chat_block])
 
     # --- Step 2: 展示处理结果 (模拟前端渲染) ---
     print("\n" + "="*50)
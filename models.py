@@ -18,13 +18,17 @@ class SmartBlock:
         
         # AI 处理后的结构化内容 (即 "阅读级文本块")
         self.processed_content: Optional[str] = None
+        # 从 processed_content 中提取的第一个 Markdown 标题，生成时算一次
+        self.title: Optional[str] = None
+        # LLM 顺带生成的一段话摘要，作为 embedding 的输入 (比全文更短、更聚焦)
+        self.summary: Optional[str] = None
         
         # 标签系统 (Phase 2 需求: 混合标签)
         self.ai_tags: List[str] = []      # AI 自动生成的
         self.user_tags: List[str] = []    # 用户手动打的
         
-        # 向量嵌入 (用于语义关联)
-        self.embedding: List[float] = []
+        # 向量嵌入 (用于语义关联): 向量统一存放在引擎的矩阵里，这里只记行号
+        self.embedding_row: Optional[int] = None
 
     def __repr__(self):
         return f"<Block {self.id[:6]}: {self.source_type} | Tags: {self.ai_tags + self.user_tags}>"
\ No newline at end of file
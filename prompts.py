@@ -7,7 +7,7 @@ VIDEO_PROCESS_PROMPT = """
 2. **保留原意**：严禁修改原意。**不要**替换指代词（保留"他/她"原样，不要自作聪明改成"OpenAI"），避免误判。
 3. **句法补全**：智能识别口语中省略的主语、宾语或谓语，并用括号 `()` 补全，确保句子结构完整。
 4. **标点与分段**：重新断句，加上正确的标点符号；根据语义逻辑进行智能分段，并为每个关键段落添加 Markdown 格式的小标题 (###)。
-5. **格式**：输出为纯 Markdown 文本。
+5. **格式**：笔记正文为纯 Markdown 文本。
 
 输入文本如下：
 {text}
@@ -29,13 +29,10 @@ CHAT_PROCESS_PROMPT = """
 {text}
 """
 
-# C. 自动打标提示词 (Auto-Tagging)
-TAGGING_PROMPT = """
-阅读以下内容，生成两类标签：
-1. **领域标签** (Broad Domain): 如 #政治学, #经济学
-2. **概念标签** (Specific Concepts): 细粒度的关键概念，如 #名实分离, #能指滑动, #央地博弈
-
-请以 JSON 格式输出列表，例如: ["#政治学", "#名实分离"]
-内容：
-{content}
+# C. 结构化输出 (笔记正文 + 标签一次调用返回)
+NOTE_JSON_FORMAT = """
+--------------------
+【输出格式】请只输出一个 JSON 对象，不要输出任何其他内容：
+{"markdown": "<完整的 Markdown 笔记正文>", "tags": ["#标签1", "#标签2", "#标签3"], "summary_for_embed": "<一段话摘要>"}
+其中 tags 为 3-5 个核心标签；summary_for_embed 用一段话 (200 字以内) 概括核心观点和概念，用于语义检索。
 """
\ No newline at end of file
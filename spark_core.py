@@ -1,86 +1,612 @@
 import os
+import re
 import json
 import time
+import atexit
+import asyncio
+import functools
+import itertools
+import threading
 import google.generativeai as genai
-from typing import List
+from urllib.parse import urlparse, parse_qs
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, TypedDict
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from models import SmartBlock
+from cache import EmbeddingCache, PromptCache, TranscriptCache
+from storage import DATA_DIR, INDEX_FILE, BlockStore, VectorStore
 import prompts
 
 # --- 库导入: 只保留字幕库，移除 yt_dlp ---
 try:
-    from youtube_transcript_api import YouTubeTranscriptApi
+    from youtube_transcript_api import YouTubeTranscriptApi, NoTranscriptFound, TranscriptsDisabled, VideoUnavailable
+    import requests
+    # 确定拿不到字幕的错误 (不是网络抖动)，可以做负缓存
+    _NO_TRANSCRIPT_ERRORS = (NoTranscriptFound, TranscriptsDisabled, VideoUnavailable)
+    # 模块级复用一个实例和一个 requests.Session (连接池 + keep-alive)
+    _yt_session = requests.Session()
+    try:
+        _yt_api = YouTubeTranscriptApi(http_client=_yt_session)
+    except TypeError:
+        # youtube-transcript-api < 1.0 不支持注入 http_client
+        _yt_api = YouTubeTranscriptApi()
 except ImportError:
     YouTubeTranscriptApi = None
+    _yt_api = None
+    _NO_TRANSCRIPT_ERRORS = ()
+
+# --- 向量检索: 优先使用 FAISS (内积 + 归一化 == 余弦相似度) ---
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# --- 可选: 不装 FAISS 时，用 Numba JIT 编译暴力检索的打分循环 (SIMD + 多线程) ---
+# 有 FAISS 时用不到，不导入 (numba 本身导入就要约 0.2s)
+njit = None
+if faiss is None:
+    try:
+        from numba import njit, prange
+    except ImportError:
+        pass
+
+# --- 可选: orjson 解析更快，没装时退回标准库 json ---
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# --- 可选: 用 tiktoken 按 token 数截断 embedding 输入，没装时按字符数截断 ---
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# --- 429 限流的异常类型 (google-generativeai 的依赖里带) ---
+try:
+    from google.api_core.exceptions import ResourceExhausted
+except ImportError:
+    ResourceExhausted = None
+
+# 向量模型及其输出维度
+EMBED_MODEL = "models/text-embedding-004"
+EMBEDDING_DIM = 768
+# 输入上限 2048 token，留些余量；没有分词器时退回字符数上限
+EMBED_MAX_TOKENS = 2000
+EMBED_MAX_CHARS = 9000
+
+# FAISS 索引结构 (index_factory 描述串)。默认 HNSW，对数级近邻搜索；
+# 内存吃紧时可改为 "SQ8" (int8 标量量化) 或 "OPQ64_256,IVF1024_HNSW32,PQ64" 这类 PQ 压缩索引
+FAISS_INDEX_SPEC = os.getenv("SPARK_FAISS_INDEX", "HNSW32")
+# 需要训练的索引 (SQ/IVF/PQ) 先用 Flat 索引过渡，攒够这么多向量后再训练并切换
+FAISS_TRAIN_SIZE = 10000
+
+# 大模型调用: 只在 429 限流时重试，等待时间从 LLM_BACKOFF_SECONDS 开始逐次翻倍
+LLM_MAX_RETRIES = 4
+LLM_BACKOFF_SECONDS = 2
+
+# FAISS 索引每新增这么多向量落盘一次 (另在退出时落盘)；
+# 没来得及落盘的行在下次启动时由向量矩阵补进索引
+INDEX_SAVE_EVERY = 1000
+
+# 向量矩阵的初始行数，之后写满即翻倍
+EMB_INITIAL_CAPACITY = 64
+
+# 关联度 (余弦相似度) 超过这个值才算相关
+RELATED_THRESHOLD = 0.3
+
+# 暴力检索: 每次只把这么多行 int8 转成 float32 参与乘法，控制临时内存；
+# 粗排多取 RESCORE_FACTOR 倍候选，再用反量化向量的精确余弦重排
+SCORE_CHUNK_ROWS = 4096
+RESCORE_FACTOR = 4
+# 行数超过 BINARY_PREFILTER_ROWS 时，粗排改用 1 bit 符号码的汉明距离 (每行 96 字节，
+# 只有 int8 的 1/8)，多取 BINARY_OVERSAMPLE 倍候选再精确重排，弥补二值化损失的精度
+BINARY_PREFILTER_ROWS = 50000
+BINARY_OVERSAMPLE = 8
+
+# 长字幕按句切成若干窗口 (约 4k token) 分别整理，再在本地合并
+TRANSCRIPT_CHUNK_CHARS = 6000
+# 同一段字幕最多同时整理这么多个窗口，避免长视频一次打出几十个请求触发 429
+TRANSCRIPT_CHUNK_CONCURRENCY = 4
+_SENTENCE_END_RE = re.compile(r'(?<=[。！？.!?])')
+
+# 支持 watch?v= / youtu.be/ / shorts/ / embed/ / live/ / v/ 等链接形式
+_YT_ID_RE = re.compile(r'[\w-]{11}')
+_YT_PATH_PREFIXES = ('shorts', 'embed', 'live', 'v')
+_YT_DOMAINS = ('youtube.com', 'youtube-nocookie.com')
+TRANSCRIPT_LANGUAGES = ['zh-CN', 'zh-Hans', 'zh-Hant', 'en']
+
+# 笔记里的第一个 Markdown 标题，作为片段标题
+_HEADING_RE = re.compile(r'^[ \t]*#+[ \t]*(.+?)[ \t]*$', re.M)
+
+# JSON 模式的输出结构，交给 Gemini 的 response_schema 约束
+class BlockNote(TypedDict):
+    markdown: str
+    tags: List[str]
+    summary_for_embed: str
+
+# 配置 API KEY；显式使用 gRPC 传输，通道在进程内复用，不必每次重新握手
+genai.configure(api_key=os.getenv("GOOGLE_API_KEY"), transport='grpc')
+
+
+@functools.lru_cache(maxsize=256)
+def _extract_video_id(url):
+    url = url.strip()
+    if "//" not in url:
+        url = "https://" + url
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").removeprefix("www.").removeprefix("m.")
+
+    if host == "youtu.be":
+        candidate = parsed.path.lstrip("/").split("/", 1)[0]
+    elif any(host == domain or host.endswith("." + domain) for domain in _YT_DOMAINS):
+        # 只认查询参数里顶层的 v，嵌套在其它参数里的不算
+        candidate = parse_qs(parsed.query).get("v", [""])[0]
+        parts = parsed.path.strip("/").split("/")
+        if not candidate and len(parts) >= 2 and parts[0] in _YT_PATH_PREFIXES:
+            candidate = parts[1]
+    else:
+        return None
+    return candidate if _YT_ID_RE.fullmatch(candidate) else None
+
+
+_transcript_cache = TranscriptCache()
+
+
+@functools.lru_cache(maxsize=64)
+def _fetch_transcript_items(video_id):
+    """抓取多语言字幕原始条目 (进程内按 video_id 缓存，跨进程走磁盘缓存)"""
+    entry = _transcript_cache.get(video_id, TRANSCRIPT_LANGUAGES)
+    if entry is not None:
+        if "error" in entry:
+            raise RuntimeError(entry["error"])
+        return entry["items"]
+
+    try:
+        if hasattr(_yt_api, "fetch"):
+            # youtube-transcript-api >= 1.0 改为实例方法
+            items = _yt_api.fetch(video_id, languages=TRANSCRIPT_LANGUAGES, preserve_formatting=False).to_raw_data()
+        else:
+            items = YouTubeTranscriptApi.get_transcript(video_id, languages=TRANSCRIPT_LANGUAGES, preserve_formatting=False)
+    except _NO_TRANSCRIPT_ERRORS as e:
+        _transcript_cache.put_error(video_id, TRANSCRIPT_LANGUAGES, str(e))
+        raise
+    _transcript_cache.put(video_id, TRANSCRIPT_LANGUAGES, items)
+    return items
+
+
+# 正在抓取的 video_id -> Future，同一视频的并发请求共用一次网络往返
+_transcript_inflight: Dict[str, Future] = {}
+_transcript_inflight_lock = threading.Lock()
+
+
+def _fetch_transcript_items_shared(video_id):
+    """_fetch_transcript_items 的并发合并版: 第一个线程去抓，其余线程等它的结果"""
+    with _transcript_inflight_lock:
+        future = _transcript_inflight.get(video_id)
+        owner = future is None
+        if owner:
+            future = _transcript_inflight[video_id] = Future()
+    if owner:
+        try:
+            future.set_result(_fetch_transcript_items(video_id))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with _transcript_inflight_lock:
+                del _transcript_inflight[video_id]
+    return future.result()
+
+
+def _fetch_transcript(video_id, start_min=None, end_min=None):
+    """字幕拼成一段文本；指定时间段 (分钟) 时只保留落在区间内的条目"""
+    transcript_list = _fetch_transcript_items_shared(video_id)
+    if start_min is None:
+        return " ".join(item['text'] for item in transcript_list)
+    lo, hi = start_min * 60, end_min * 60
+    return " ".join(item['text'] for item in transcript_list if lo <= item['start'] <= hi)
+
+
+def _is_rate_limited(error):
+    if ResourceExhausted is not None and isinstance(error, ResourceExhausted):
+        return True
+    return "429" in str(error)
+
+
+def _retry_delay(error, attempt):
+    """LLM 调用的重试策略: 429 限流且还有重试次数时返回等待秒数 (逐次翻倍)，否则返回 None"""
+    if attempt == LLM_MAX_RETRIES or not _is_rate_limited(error):
+        return None
+    delay = LLM_BACKOFF_SECONDS * 2 ** attempt
+    print(f"⏳ API 限流，{delay}s 后重试...")
+    return delay
+
+
+def _loads_note(text):
+    """解析模型返回的 JSON 对象: 截取第一个 { 到最后一个 } 之间，去掉可能包着的 ```json 代码块"""
+    start, end = text.find("{"), text.rfind("}")
+    if start > 0 or 0 <= end < len(text) - 1:
+        text = text[start:end + 1]
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def _parse_note(text):
+    """解析并校验一条笔记: 必须是 markdown 为字符串的对象，tags 为字符串列表。
+    形状不对的结果和解析失败一样抛 ValueError；缺省的 tags / summary_for_embed 补成空值"""
+    note = _loads_note(text)
+    if not isinstance(note, dict) or not isinstance(note.get("markdown"), str):
+        raise ValueError("note JSON 缺少 markdown 字段")
+    tags = note.get("tags") or []
+    summary = note.get("summary_for_embed") or ""
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags) or not isinstance(summary, str):
+        raise ValueError("note JSON 的 tags / summary_for_embed 类型不对")
+    note["tags"], note["summary_for_embed"] = tags, summary
+    return note
+
+
+def _split_text(text, limit=TRANSCRIPT_CHUNK_CHARS):
+    """在句末标点处切分，拼成不超过 limit 字符的若干段"""
+    pieces = []
+    for sentence in _SENTENCE_END_RE.split(text):
+        # 自动字幕经常没有标点，超长的句子直接硬切
+        pieces.extend(sentence[i:i + limit] for i in range(0, len(sentence), limit))
+
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > limit:
+            chunks.append(current)
+            current = ""
+        current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _int8_scores(codes, scales, query):
+        """int8 矩阵逐行点乘 float32 查询向量，再乘回每行缩放系数"""
+        n, d = codes.shape
+        scores = np.empty(n, np.float32)
+        for i in prange(n):
+            acc = np.float32(0.0)
+            for j in range(d):
+                acc += codes[i, j] * query[j]
+            scores[i] = acc * scales[i]
+        return scores
+else:
+    _int8_scores = None
+
+
+def _l2_normalize(vec):
+    """L2 归一化 (原地，矩阵按行)，归一化后内积即余弦相似度"""
+    vec /= np.linalg.norm(vec, axis=-1, keepdims=True) + 1e-12
+    return vec
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoder():
+    """编码器只初始化一次；首次使用要下载词表，失败时返回 None"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def _truncate_for_embedding(text):
+    encoder = _token_encoder()
+    if encoder is None:
+        return text[:EMBED_MAX_CHARS]
+    # 先按字符粗截一刀 (一个 token 很少超过 8 个字符)，不必对整份长字幕分词
+    head = text[:EMBED_MAX_TOKENS * 8]
+    tokens = encoder.encode(head, disallowed_special=())
+    if len(tokens) <= EMBED_MAX_TOKENS:
+        return head
+    # 截断处可能落在多字节字符中间，去掉残留的替换符
+    return encoder.decode(tokens[:EMBED_MAX_TOKENS]).rstrip("\ufffd")
+
+
+def _grow(array, used, capacity):
+    """分配 capacity 行的新数组，只拷贝前 used 行有效数据；配合翻倍扩容，追加的均摊代价为 O(D)"""
+    grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    np.copyto(grown[:used], array[:used])
+    return grown
+
+
+# 0..255 每个字节里 1 的个数
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def _top_k(scores, k):
+    """返回得分最高的 k 个下标 (降序)；argpartition 只做部分选择，O(N)"""
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    idx = np.argpartition(scores, -k)[-k:]
+    return idx[np.argsort(-scores[idx])]
 
-# 配置 API KEY
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
 class SparkEngine:
-    def __init__(self):
+    def __init__(self, data_dir: Optional[str] = DATA_DIR):
         self.database: List[SmartBlock] = []
+        # id -> SmartBlock, O(1) 查找
+        self.by_id: Dict[str, SmartBlock] = {}
+        # 页面会在后台线程里调用 process_block，写入向量和检索时互斥
+        self._lock = threading.RLock()
+        # 所有向量 (已归一化) 按行量化成 int8 存在一个连续矩阵里，每行一个缩放系数，
+        # 容量按倍数增长；前 emb_count 行有效，id_map[i] 对应第 i 行 (与 FAISS 索引中的编号一致)
+        self.emb_codes = np.empty((EMB_INITIAL_CAPACITY, EMBEDDING_DIM), dtype=np.int8)
+        self.emb_scales = np.empty(EMB_INITIAL_CAPACITY, dtype=np.float32)
+        self.emb_count = 0
+        # 每行的符号位打包成 D/8 字节，只在无 FAISS 的大库汉明粗排时用到，
+        # 第一次用时由 int8 码生成，前 _bits_count 行有效
+        self.emb_bits = np.empty((0, EMBEDDING_DIM // 8), dtype=np.uint8)
+        self._bits_count = 0
+        # FAISS 索引随 process_block 增量维护
+        self.index = None
+        self._untrained_index = None
+        if faiss:
+            self.index = self._build_index()
+            if not self.index.is_trained:
+                self._untrained_index = self.index
+                self.index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        self.id_map: List[str] = []
+        # 片段和向量落盘，重启后直接加载，不再重新 embedding；data_dir=None 时只放内存
+        self.store = BlockStore(data_dir) if data_dir else None
+        self.vectors: Optional[VectorStore] = None
+        # 已落盘的索引包含的向量数
+        self._index_saved = 0
+        # 第一个片段记录没能落盘的向量行: 有效行数不再提交到它之后，避免重启后出现没有片段的行
+        self._unsaved_row: Optional[int] = None
+        # 相同内容不再重复请求 embedding (加载时补向量也会用到)
+        self.embedding_cache = EmbeddingCache()
+        if self.store:
+            self._load()
+            atexit.register(self.save_index)
+        if self.index is None and _int8_scores is not None:
+            # 预热: 在初始化时完成 JIT 编译，避免第一次检索卡顿
+            _int8_scores(np.zeros((1, EMBEDDING_DIM), np.int8), np.ones(1, np.float32), np.zeros(EMBEDDING_DIM, np.float32))
+        # 相同或几乎相同的输入直接复用上次的笔记 (按来源类型分开缓存)
+        self.note_caches: Dict[str, PromptCache] = defaultdict(PromptCache)
         # 保留修复: 使用最新的 2.5 版本
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        # JSON 模式: 笔记正文和标签在同一次调用里结构化返回，
+        # response_schema 保证返回的一定是合法的 BlockNote
+        self.json_model = genai.GenerativeModel(
+            'gemini-2.5-flash',
+            generation_config={'response_mime_type': 'application/json', 'response_schema': BlockNote}
+        )
 
     def _call_llm(self, prompt):
-        """调用大模型"""
-        # 保留修复: 强制休息 2 秒，防止 429 报错
-        print("⏳ 正在等待 API 冷却 (2s)...")
-        time.sleep(2) 
-        
-        try:
-            response = self.model.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            return f"Error processing AI: {e}"
+        """调用大模型，遇到 429 限流时指数退避后重试"""
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                response = self.json_model.generate_content(prompt)
+                return response.text
+            except Exception as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None:
+                    return f"Error processing AI: {e}"
+                time.sleep(delay)
+
+    async def _call_llm_async(self, prompt):
+        """_call_llm 的异步版本，退避期间不阻塞其它片段。
+        不用 generate_content_async: SDK 缓存的异步 gRPC 客户端绑定在第一个事件循环上，
+        process_blocks 每次 asyncio.run 都是新循环，第二次调用会全部失败；同步接口放到线程里跑"""
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                response = await asyncio.to_thread(self.json_model.generate_content, prompt)
+                return response.text
+            except Exception as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None:
+                    return f"Error processing AI: {e}"
+                await asyncio.sleep(delay)
 
-    def _get_youtube_transcript(self, url):
+    def _get_youtube_transcript(self, url, start_min=None, end_min=None):
         """只抓取字幕"""
         if not YouTubeTranscriptApi:
             return None, "❌ 未安装 transcript 库"
             
         try:
-            video_id = None
-            if "v=" in url:
-                video_id = url.split("v=")[1].split("&")[0]
-            elif "youtu.be/" in url:
-                video_id = url.split("youtu.be/")[1].split("?")[0]
-            
+            video_id = _extract_video_id(url)
             if not video_id:
                 return None, "无法解析 Video ID"
 
-            # 尝试抓取多语言字幕
-            transcript_list = YouTubeTranscriptApi.get_transcript(video_id, languages=['zh-CN', 'zh-Hans', 'zh-Hant', 'en'])
-            full_text = " ".join([t['text'] for t in transcript_list])
+            full_text = _fetch_transcript(video_id, start_min, end_min)
+            if not full_text:
+                return None, "所选时间段内没有字幕"
             return f"[自动抓取的字幕] {full_text}", None
             
         except Exception as e:
             return None, str(e)
 
     def _get_embedding(self, text):
+        """单条 embedding，走批量接口"""
+        return self._get_embeddings_batch([text])[0]
+
+    async def _get_embedding_async(self, text):
+        return (await asyncio.to_thread(self._get_embeddings_batch, [text]))[0]
+
+    def _get_embeddings_batch(self, texts: List[str], batch=100) -> List[List[float]]:
+        """批量 embedding: 缓存未命中的文本按 batch 条一组请求，结果按原顺序返回"""
+        truncated = [_truncate_for_embedding(text) for text in texts]
+        keys = [EmbeddingCache.key(EMBED_MODEL, text) for text in truncated]
+        results = [self.embedding_cache.get(key) for key in keys]
+
+        missing = iter([i for i, r in enumerate(results) if r is None])
+        while chunk := list(itertools.islice(missing, batch)):
+            try:
+                result = genai.embed_content(
+                    model=EMBED_MODEL,
+                    content=[truncated[i] for i in chunk],
+                    task_type="retrieval_document",
+                    title="Spark Block"
+                )
+            except Exception as e:
+                print(f"❌ Embedding 失败: {e}")
+                continue
+            for i, embedding in zip(chunk, result['embedding']):
+                results[i] = embedding
+                self.embedding_cache.put(keys[i], embedding)
+
+        return [r if r is not None else [] for r in results]
+
+    def _build_prompt(self, block: SmartBlock, prompt_text):
+        """按来源类型套用提示词，并附上 JSON 输出格式"""
+        if block.source_type == "video_snippet":
+            # 简化 Prompt，不再需要处理音频的逻辑
+            final_prompt = prompts.VIDEO_PROCESS_PROMPT.format(text=prompt_text)
+        elif block.source_type == "chat_log":
+            final_prompt = prompts.CHAT_PROCESS_PROMPT.format(text=prompt_text)
+        else:
+            final_prompt = prompt_text
+
+        # --- 合并 Prompt: 笔记 + 标签 一次 JSON 调用搞定 ---
+        return final_prompt + prompts.NOTE_JSON_FORMAT
+
+    def _is_long_transcript(self, block: SmartBlock, prompt_text):
+        return block.source_type == "video_snippet" and len(prompt_text) > TRANSCRIPT_CHUNK_CHARS
+
+    def _merge_notes(self, responses):
+        """合并分段整理的结果: 正文按顺序拼接，标签按出现次数取前 5 个"""
+        notes = []
+        for response in responses:
+            try:
+                notes.append(_parse_note(response))
+            except ValueError:
+                # 任何一段失败都原样返回，交给 _apply_note 报错
+                return response
+
+        tag_counts = Counter(tag for note in notes for tag in note["tags"])
+        return json.dumps({
+            "markdown": "\n\n".join(note["markdown"].strip() for note in notes),
+            "tags": [tag for tag, _ in tag_counts.most_common(5)],
+            "summary_for_embed": " ".join(note["summary_for_embed"].strip() for note in notes),
+        }, ensure_ascii=False)
+
+    def _semantic_cacheable(self, prompt_text):
+        """超出 embedding 窗口的输入只有开头参与向量，开头相同的不同输入 (如同一视频的不同时间段)
+        会得到同一个向量，只走精确匹配"""
+        return _truncate_for_embedding(prompt_text) == prompt_text
+
+    def _lookup_note(self, block: SmartBlock, prompt_text, embedding=None):
+        """两级缓存: 先按输入哈希精确匹配，再按输入向量找近似的输入。
+        embedding 为 None 时现取输入向量 (批量路径会提前一次算好传进来)。
+        返回 (key, 输入向量, 命中的结果)"""
+        cache = self.note_caches[block.source_type]
+        key = PromptCache.key(prompt_text)
+        cached = cache.get(key)
+        if cached is not None:
+            return key, None, cached
+        if not self._semantic_cacheable(prompt_text):
+            return key, None, None
+        if embedding is None:
+            embedding = self._get_embedding(prompt_text)
+        return key, embedding, cache.get_similar(embedding, len(prompt_text)) if embedding else None
+
+    def _remember_note(self, block: SmartBlock, prompt_text, key, embedding, response):
         try:
-            time.sleep(1)
-            truncated_text = text[:9000]
-            result = genai.embed_content(
-                model="models/text-embedding-004",
-                content=truncated_text,
-                task_type="retrieval_document", 
-                title="Spark Block" 
-            )
-            return result['embedding']
-        except Exception as e:
-            return []
+            _parse_note(response)
+        except ValueError:
+            # 只缓存能解析成合法笔记的结果
+            return
+        self.note_caches[block.source_type].put(key, embedding, len(prompt_text), response)
 
-    def process_block(self, block: SmartBlock, file_bytes=None):
-        print(f"🔄 [Gemini] 正在处理: {block.source_type} ...")
-        
+    def _generate_note(self, block: SmartBlock, prompt_text):
+        """生成笔记 JSON；先查缓存，长字幕走 map-reduce 并行整理"""
+        key, embedding, cached = self._lookup_note(block, prompt_text)
+        if cached is not None:
+            print("♻️ 命中缓存，跳过 LLM 调用")
+            return cached
+
+        if self._is_long_transcript(block, prompt_text):
+            response = self._shape_long_transcript(block, prompt_text)
+        else:
+            response = self._call_llm(self._build_prompt(block, prompt_text))
+        self._remember_note(block, prompt_text, key, embedding, response)
+        return response
+
+    async def _generate_note_async(self, block: SmartBlock, prompt_text, embedding=None):
+        key, embedding, cached = await asyncio.to_thread(self._lookup_note, block, prompt_text, embedding)
+        if cached is not None:
+            print("♻️ 命中缓存，跳过 LLM 调用")
+            return cached
+
+        if self._is_long_transcript(block, prompt_text):
+            response = await self._shape_long_transcript_async(block, prompt_text)
+        else:
+            response = await self._call_llm_async(self._build_prompt(block, prompt_text))
+        self._remember_note(block, prompt_text, key, embedding, response)
+        return response
+
+    def _shape_long_transcript(self, block: SmartBlock, prompt_text):
+        """同步路径: 用有界线程池并行整理各窗口。
+        不在这里 asyncio.run，SDK 缓存的异步 gRPC 客户端绑定在创建它的事件循环上"""
+        chunks = _split_text(prompt_text)
+        print(f"✂️ 字幕较长，分 {len(chunks)} 段并行整理")
+        with ThreadPoolExecutor(max_workers=min(TRANSCRIPT_CHUNK_CONCURRENCY, len(chunks))) as pool:
+            responses = list(pool.map(
+                lambda chunk: self._call_llm(self._build_prompt(block, chunk)), chunks
+            ))
+        return self._merge_notes(responses)
+
+    async def _shape_long_transcript_async(self, block: SmartBlock, prompt_text):
+        chunks = _split_text(prompt_text)
+        print(f"✂️ 字幕较长，分 {len(chunks)} 段并行整理")
+        semaphore = asyncio.Semaphore(TRANSCRIPT_CHUNK_CONCURRENCY)
+
+        async def shape(chunk):
+            async with semaphore:
+                return await self._call_llm_async(self._build_prompt(block, chunk))
+
+        responses = await asyncio.gather(*(shape(chunk) for chunk in chunks))
+        return self._merge_notes(responses)
+
+    def _apply_note(self, block: SmartBlock, full_response, status_msg):
+        """解析 JSON 模式的返回结果，写回 block"""
+        # 没有状态前缀时不留开头的空行
+        prefix = f"{status_msg}\n\n" if status_msg else ""
+        try:
+            note = _parse_note(full_response)
+            block.processed_content = prefix + note['markdown'].strip()
+            block.ai_tags = note["tags"]
+            block.summary = note["summary_for_embed"] or None
+        except ValueError:
+            block.processed_content = prefix + full_response
+            block.ai_tags = ["#TagParseError"]
+
+        heading = _HEADING_RE.search(block.processed_content)
+        block.title = heading.group(1) if heading else None
+
+    def _embedding_text(self, block: SmartBlock):
+        """embedding 的输入: 优先用摘要，没有摘要时退回全文"""
+        return block.summary or block.processed_content
+
+    def _needs_embedding(self, block: SmartBlock):
+        return bool(block.processed_content) and "Error" not in block.processed_content
+
+    def _add_to_database(self, block: SmartBlock, embedding):
+        with self._lock:
+            self.database.append(block)
+            self.by_id[block.id] = block
+            if embedding:
+                block.embedding_row = self._store_embedding(block.id, embedding)
+            self._persist(block, vectors_changed=bool(embedding))
+        print(f"✅ 处理完成: ID {block.id[:6]}")
+
+    def _resolve_source(self, block: SmartBlock):
+        """返回 (送给 LLM 的文本, 状态前缀)；字幕抓取失败时写入错误信息并返回 (None, None)"""
         prompt_text = block.raw_content
         status_msg = ""
 
         # === 核心逻辑: 只处理字幕 ===
         if block.source_type == "video_snippet" and ("youtube.com" in block.raw_content or "youtu.be" in block.raw_content):
-            transcript_text, error = self._get_youtube_transcript(block.raw_content)
+            transcript_text, error = self._get_youtube_transcript(
+                block.raw_content, block.metadata.get("start_min"), block.metadata.get("end_min")
+            )
             
             if transcript_text:
                 print("✅ 成功抓取字幕")
@@ -90,60 +616,380 @@ class SparkEngine:
                 # 如果没有字幕，直接报错，不再尝试下载音频
                 print(f"❌ 字幕获取失败: {error}")
                 block.processed_content = f"❌ 此视频没有CC字幕，且音频下载功能已关闭。\n错误信息: {error}"
-                return
+                return None, None
 
-        # === 准备 Prompt ===
-        if block.source_type == "video_snippet":
-            # 简化 Prompt，不再需要处理音频的逻辑
-            final_prompt = prompts.VIDEO_PROCESS_PROMPT.format(text=prompt_text)
-        elif block.source_type == "chat_log":
-            final_prompt = prompts.CHAT_PROCESS_PROMPT.format(text=prompt_text)
-        else:
-            final_prompt = prompt_text
-        
-        # --- 保留修复: 合并 Prompt (总结+标签 一次搞定) ---
-        combined_prompt = final_prompt + "\n\n" + "-"*20 + "\n【附加任务】在笔记的最后，请务必另起一行，以 JSON 格式输出 3-5 个核心标签，格式严格如下：\nTagsJSON: [\"#标签1\", \"#标签2\", \"#标签3\"]"
+        return prompt_text, status_msg
+
+    def process_block(self, block: SmartBlock, file_bytes=None):
+        print(f"🔄 [Gemini] 正在处理: {block.source_type} ...")
+
+        prompt_text, status_msg = self._resolve_source(block)
+        if prompt_text is None:
+            return
 
         # 1. 调用 LLM
-        full_response = self._call_llm(combined_prompt)
-        
+        full_response = self._generate_note(block, prompt_text)
+
         # 2. 解析结果
-        if full_response and "TagsJSON:" in full_response:
-            try:
-                parts = full_response.split("TagsJSON:")
-                content_part = parts[0].strip()
-                tags_json_str = parts[1].strip().replace("```json", "").replace("```", "").strip()
-                
-                block.processed_content = f"{status_msg}\n\n{content_part}"
-                block.ai_tags = json.loads(tags_json_str)
-            except:
-                block.processed_content = f"{status_msg}\n\n{full_response}"
-                block.ai_tags = ["#TagParseError"]
-        else:
-            block.processed_content = f"{status_msg}\n\n{full_response}"
-            block.ai_tags = []
+        self._apply_note(block, full_response, status_msg)
 
         # 3. Embedding
-        if block.processed_content and "Error" not in block.processed_content:
-            block.embedding = self._get_embedding(block.processed_content)
+        if self._needs_embedding(block):
+            self._add_to_database(block, self._get_embedding(self._embedding_text(block)))
+
+    async def process_block_async(self, block: SmartBlock):
+        """process_block 的异步版本: 字幕抓取、LLM、Embedding 都不阻塞事件循环"""
+        print(f"🔄 [Gemini] 正在处理: {block.source_type} ...")
+
+        # 字幕库没有异步接口，放到线程里跑
+        prompt_text, status_msg = await asyncio.to_thread(self._resolve_source, block)
+        if prompt_text is None:
+            return
+
+        if await self._note_block_async(block, prompt_text, status_msg):
+            self._add_to_database(block, await self._get_embedding_async(self._embedding_text(block)))
+
+    async def _note_block_async(self, block: SmartBlock, prompt_text, status_msg, embedding=None):
+        """生成笔记并写回 block，返回是否需要 embedding"""
+        full_response = await self._generate_note_async(block, prompt_text, embedding)
+        self._apply_note(block, full_response, status_msg)
+        return self._needs_embedding(block)
+
+    async def process_blocks_async(self, blocks: List[SmartBlock], concurrency=8):
+        """并发处理多个片段，Semaphore 限制同时在途的请求数。
+        笔记缓存用的输入向量在调用 LLM 前一次批量算好，笔记全部生成后再一次性批量 embedding"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve(block):
+            print(f"🔄 [Gemini] 正在处理: {block.source_type} ...")
+            async with semaphore:
+                # 字幕库没有异步接口，放到线程里跑
+                return await asyncio.to_thread(self._resolve_source, block)
+
+        sources = await asyncio.gather(*(resolve(block) for block in blocks))
+
+        # 精确命中缓存的、超出 embedding 窗口的输入不需要向量
+        lookups = [
+            i for i, (block, (prompt_text, _)) in enumerate(zip(blocks, sources))
+            if prompt_text is not None and self._semantic_cacheable(prompt_text)
+            and self.note_caches[block.source_type].get(PromptCache.key(prompt_text)) is None
+        ]
+        input_embeddings = [None] * len(blocks)
+        if lookups:
+            batch = await asyncio.to_thread(self._get_embeddings_batch, [sources[i][0] for i in lookups])
+            for i, embedding in zip(lookups, batch):
+                input_embeddings[i] = embedding
+
+        async def run(block, source, embedding):
+            prompt_text, status_msg = source
+            if prompt_text is None:
+                return False
+            async with semaphore:
+                return await self._note_block_async(block, prompt_text, status_msg, embedding)
+
+        flags = await asyncio.gather(*(run(*args) for args in zip(blocks, sources, input_embeddings)))
+        ready = [block for block, flag in zip(blocks, flags) if flag]
+        if not ready:
+            return
+
+        embeddings = await asyncio.to_thread(self._get_embeddings_batch, [self._embedding_text(b) for b in ready])
+        for block, embedding in zip(ready, embeddings):
+            self._add_to_database(block, embedding)
+
+    def process_blocks(self, blocks: List[SmartBlock], concurrency=8):
+        """process_blocks_async 的同步入口"""
+        asyncio.run(self.process_blocks_async(blocks, concurrency))
+
+    def _load(self):
+        """冷启动: 从磁盘恢复片段，映射向量矩阵，加载 FAISS 索引"""
+        self.vectors = VectorStore(self.store.data_dir, EMBEDDING_DIM, EMB_INITIAL_CAPACITY)
+        self.emb_codes, self.emb_scales = self.vectors.codes, self.vectors.scales
+        self.emb_count = n = self.vectors.count
+
+        # 行号 -> id 由片段记录的 embedding_row 还原 (片段总是先于有效行数落盘)；
+        # 找不到片段的行 (旧数据里片段保存失败的) 为 None，检索时跳过
+        self.id_map = [None] * n
+        for block in self.store.load_blocks():
+            if block.embedding_row is not None and block.embedding_row >= n:
+                # 向量没来得及提交，这一行之后会被复用: 清掉记录，由 _reembed_missing 重新入库
+                block.embedding_row = None
+                self.store.save_block(block)
+            if block.embedding_row is not None:
+                self.id_map[block.embedding_row] = block.id
             self.database.append(block)
-            print(f"✅ 处理完成: ID {block.id[:6]}")
+            self.by_id[block.id] = block
+
+        self._load_index()
+        self._reembed_missing()
+
+    def _load_index(self):
+        if self.index is None or self.emb_count == 0:
+            return
+        index_path = self.store.path(INDEX_FILE)
+        index = faiss.read_index(index_path) if os.path.exists(index_path) else None
+        if index is not None and index.ntotal <= self.emb_count:
+            self.index, self._untrained_index = index, None
+            self._index_saved = index.ntotal
+        # 索引文件缺失时从头重建，落后时只补上后面的行
+        for start in range(self.index.ntotal, self.emb_count, SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, self.emb_count)
+            self._index_add(_l2_normalize(self.emb_codes[start:end].astype(np.float32) * self.emb_scales[start:end, None]))
+
+    def _reembed_missing(self):
+        """向量没提交或当初 embedding 失败的片段: 重新 embedding 并入库 (多半直接命中 embedding 缓存)"""
+        missing = [b for b in self.database if b.embedding_row is None and self._needs_embedding(b)]
+        if not missing:
+            return
+        print(f"🔁 {len(missing)} 个片段缺少向量，重新 embedding")
+        embeddings = self._get_embeddings_batch([self._embedding_text(b) for b in missing])
+        for block, embedding in zip(missing, embeddings):
+            if embedding:
+                block.embedding_row = self._store_embedding(block.id, embedding)
+                self._persist(block)
+
+    def _persist(self, block: SmartBlock, vectors_changed=True):
+        if self.store is None:
+            return
+        try:
+            self.store.save_block(block)
+        except Exception:
+            if vectors_changed and block.embedding_row is not None and self._unsaved_row is None:
+                self._unsaved_row = block.embedding_row
+            raise
+        if not vectors_changed:
+            return
+
+        # 向量行已直接写在 memmap 里，这里只提交有效行数
+        self.vectors.commit(self.emb_count if self._unsaved_row is None else self._unsaved_row)
+        # 整个索引重写一次是 O(N)，攒够 INDEX_SAVE_EVERY 行再写
+        if self.index is not None and self.index.ntotal - self._index_saved >= INDEX_SAVE_EVERY:
+            self._save_index()
+
+    def save_index(self):
+        """把 FAISS 索引落盘 (退出时自动调用)"""
+        with self._lock:
+            if self.store is not None and self.index is not None and self.index.ntotal > self._index_saved:
+                self._save_index()
+
+    def _save_index(self):
+        # 需要训练的索引还在 Flat 过渡期时不落盘，加载时由矩阵重建
+        if self._untrained_index is not None:
+            return
+        index_path = self.store.path(INDEX_FILE)
+        faiss.write_index(self.index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+        self._index_saved = self.index.ntotal
+
+    def _build_index(self):
+        """按 FAISS_INDEX_SPEC 创建内积索引"""
+        index = faiss.index_factory(EMBEDDING_DIM, FAISS_INDEX_SPEC, faiss.METRIC_INNER_PRODUCT)
+        if hasattr(index, "hnsw"):
+            index.hnsw.efConstruction = 200
+            index.hnsw.efSearch = 64
+        return index
+
+    def _index_add(self, vec):
+        self.index.add(vec)
+        if self._untrained_index is None or self.index.ntotal < FAISS_TRAIN_SIZE:
+            return
+        # 过渡用的 Flat 索引已攒够样本: 训练正式索引，整体迁移过去
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        target = self._untrained_index
+        target.train(vectors)
+        target.add(vectors)
+        if "IVF" in FAISS_INDEX_SPEC:
+            faiss.ParameterSpace().set_index_parameter(target, "nprobe", 16)
+        self.index, self._untrained_index = target, None
+
+    def _store_embedding(self, block_id, embedding):
+        """归一化、量化后写入矩阵 (容量不足时翻倍)，同步加入 FAISS 索引，返回行号"""
+        vec = _l2_normalize(np.array(embedding, dtype=np.float32))
+
+        row = self.emb_count
+        if row >= self.emb_codes.shape[0]:
+            capacity = max(EMB_INITIAL_CAPACITY, self.emb_codes.shape[0] * 2)
+            if self.vectors is not None:
+                self.vectors.grow(capacity)
+                self.emb_codes, self.emb_scales = self.vectors.codes, self.vectors.scales
+            else:
+                self.emb_codes = _grow(self.emb_codes, row, capacity)
+                self.emb_scales = _grow(self.emb_scales, row, capacity)
+        # 对称 absmax 量化: 每行一个缩放系数，int8 取值 [-127, 127]
+        scale = np.abs(vec).max() / 127.0 or 1.0
+        self.emb_codes[row] = np.clip(np.round(vec / scale), -127, 127)
+        self.emb_scales[row] = scale
+        self.emb_count += 1
+        self.id_map.append(block_id)
+
+        if self.index is not None:
+            self._index_add(vec.reshape(1, -1))
+        return row
+
+    def _embedding_vector(self, row):
+        """反量化第 row 行并重新归一化，作为查询向量 (量化会让模长略偏离 1)"""
+        return _l2_normalize(self.emb_codes[row].astype(np.float32) * self.emb_scales[row])
 
     def find_related(self, target_block: SmartBlock, top_k=3):
-        # ... (这部分保持不变) ...
-        if not target_block.embedding or not self.database:
-            return []
-        db_embeddings = [b.embedding for b in self.database if b.id != target_block.id and b.embedding]
-        db_blocks = [b for b in self.database if b.id != target_block.id and b.embedding]
-        if not db_embeddings:
+        with self._lock:
+            return self._find_related(target_block, top_k)
+
+    def _find_related(self, target_block: SmartBlock, top_k=3):
+        if target_block.embedding_row is None or self.emb_count == 0:
             return []
-        target_vec = np.array(target_block.embedding).reshape(1, -1)
-        db_matrix = np.array(db_embeddings)
-        similarities = cosine_similarity(target_vec, db_matrix)[0]
-        top_indices = similarities.argsort()[-top_k:][::-1]
+        if self.index is None:
+            return self._find_related_bruteforce(target_block, top_k)
+
+        # 多取一个，用于跳过目标块自身
+        query = self._embedding_vector(target_block.embedding_row).reshape(1, -1)
+        scores, indices = self.index.search(query, top_k + 1)
+        return self._index_results(target_block.id, scores[0], indices[0], top_k)
+
+    def _index_results(self, target_id, scores, indices, top_k):
+        """FAISS 一行检索结果: 跳过无效位和目标块自身，按阈值过滤"""
+        results = []
+        for score, idx in zip(scores, indices):
+            if idx < 0:
+                continue
+            block_id = self.id_map[idx]
+            if block_id is None or block_id == target_id:
+                continue
+            if score > RELATED_THRESHOLD:
+                results.append((self.by_id[block_id], float(score)))
+        return results[:top_k]
+
+    def find_related_all(self, blocks: List[SmartBlock] = None, top_k=3):
+        """批量版 find_related: 一组片段 (默认全部) 一起检索，结果与逐个调用 find_related 一致，
+        返回 {block.id: [(block, score), ...]}"""
+        with self._lock:
+            n = self.emb_count
+            if blocks is None:
+                blocks = [self.by_id[block_id] for block_id in self.id_map[:n] if block_id is not None]
+            results = {block.id: [] for block in blocks}
+            targets = [b for b in blocks if b.embedding_row is not None]
+            if not targets:
+                return results
+
+            if self.index is None and n >= BINARY_PREFILTER_ROWS:
+                for block in targets:
+                    results[block.id] = self._find_related_bruteforce(block, top_k)
+                return results
+
+            # 查询向量按行反量化、归一化，每次最多 1024 个
+            for start in range(0, len(targets), 1024):
+                chunk = targets[start:start + 1024]
+                rows = np.array([b.embedding_row for b in chunk], dtype=np.intp)
+                queries = np.stack([self._embedding_vector(row) for row in rows])
+                if self.index is not None:
+                    scores, indices = self.index.search(queries, top_k + 1)
+                    for block, row_scores, row_indices in zip(chunk, scores, indices):
+                        results[block.id] = self._index_results(block.id, row_scores, row_indices, top_k)
+                    continue
+
+                candidates, coarse = self._int8_candidates(queries, rows, top_k * RESCORE_FACTOR)
+                for block, query, row_candidates, row_coarse in zip(chunk, queries, candidates, coarse):
+                    # 与 _find_related_bruteforce 相同: 粗排过阈值的候选再精确重排
+                    results[block.id] = self._rescored_results(query, row_candidates[row_coarse > RELATED_THRESHOLD], top_k)
+            return results
+
+    def _int8_candidates(self, queries, rows, k):
+        """多个查询向量对 int8 矩阵分块打分 (每次 SCORE_CHUNK_ROWS 行)，
+        只保留每个查询的前 k 个候选；返回 (候选行号, 粗排分数)，均为 (查询数, ≤k)"""
+        n = self.emb_count
+        best_idx = np.empty((len(rows), 0), dtype=np.intp)
+        best_scores = np.empty((len(rows), 0), dtype=np.float32)
+        for start in range(0, n, SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, n)
+            sims = queries @ self.emb_codes[start:end].T
+            sims *= self.emb_scales[start:end]
+            # 排除各查询自身
+            own = (rows >= start) & (rows < end)
+            sims[np.flatnonzero(own), rows[own] - start] = -np.inf
+
+            idx = np.concatenate([best_idx, np.broadcast_to(np.arange(start, end), sims.shape)], axis=1)
+            scores = np.concatenate([best_scores, sims], axis=1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                idx = np.take_along_axis(idx, keep, axis=1)
+                scores = np.take_along_axis(scores, keep, axis=1)
+            best_idx, best_scores = idx, scores
+        return best_idx, best_scores
+
+    def _int8_matvec(self, query, n):
+        """前 n 行 int8 矩阵乘 float32 查询向量 (近似余弦)"""
+        if _int8_scores is not None:
+            return _int8_scores(self.emb_codes[:n], self.emb_scales[:n], query)
+        # 分块计算，避免把整个 int8 矩阵一次性转成 float32
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, n)
+            scores[start:end] = self.emb_codes[start:end] @ query
+        return scores * self.emb_scales[:n]
+
+    def _sync_binary_codes(self):
+        """把符号码补齐到 emb_count 行: 由 int8 码取符号位，只处理还没生成的行"""
+        n = self.emb_count
+        if self._bits_count == n:
+            return
+        if self.emb_bits.shape[0] < n:
+            self.emb_bits = _grow(self.emb_bits, self._bits_count, max(n, self.emb_bits.shape[0] * 2))
+        for start in range(self._bits_count, n, SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, n)
+            self.emb_bits[start:end] = np.packbits(self.emb_codes[start:end] > 0, axis=1)
+        self._bits_count = n
+
+    def _hamming_distances(self, query_bits, n):
+        """前 n 行符号码与查询符号码的汉明距离"""
+        distances = np.empty(n, dtype=np.int32)
+        for start in range(0, n, SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, n)
+            xor = np.bitwise_xor(self.emb_bits[start:end], query_bits)
+            # NumPy 2.0+ 有逐字节 popcount，旧版本查表
+            counts = np.bitwise_count(xor) if hasattr(np, "bitwise_count") else _POPCOUNT[xor]
+            distances[start:end] = counts.sum(axis=1, dtype=np.int32)
+        return distances
+
+    def _rescore(self, query, candidates):
+        """只反量化候选行，按精确余弦重新打分"""
+        vectors = self.emb_codes[candidates].astype(np.float32) * self.emb_scales[candidates, None]
+        # 查询向量已归一化，只需除以候选行的模长
+        return (vectors @ query) / (np.linalg.norm(vectors, axis=1) + 1e-12)
+
+    def _find_related_bruteforce(self, target_block: SmartBlock, top_k=3):
+        """未安装 FAISS 时的退路: 向量入库时已归一化，余弦相似度就是一次矩阵-向量乘法
+        (int8 矩阵乘查询向量，再乘回每行的缩放系数)，粗排后对少量候选精确重排"""
+        target_row = target_block.embedding_row
+        n = self.emb_count
+        query = self._embedding_vector(target_row)
+        if n >= BINARY_PREFILTER_ROWS:
+            return self._find_related_binary(target_row, query, top_k)
+        similarities = self._int8_matvec(query, n)
+        # 排除目标块自身 (-inf 不会被任何阈值选中)
+        similarities[target_row] = -np.inf
+
+        # 先筛掉明显不相关的，再在剩下的里做部分选择 (目标块自身为 -inf，也被筛掉)
+        eligible = np.flatnonzero(similarities > RELATED_THRESHOLD)
+        candidates = eligible[_top_k(similarities[eligible], top_k * RESCORE_FACTOR)]
+        return self._rescored_results(query, candidates, top_k)
+
+    def _rescored_results(self, query, candidates, top_k):
+        """候选行精确重排，取前 top_k 个过阈值的"""
+        exact = self._rescore(query, candidates)
         results = []
-        for idx in top_indices:
-            score = similarities[idx]
-            if score > 0.3:
-                results.append((db_blocks[idx], score))
-        return results
\ No newline at end of file
+        # 候选只有 top_k * RESCORE_FACTOR 个，整体排序后跳过没有片段的行
+        for i in _top_k(exact, exact.size):
+            score = exact[i]
+            if score <= RELATED_THRESHOLD or len(results) == top_k:
+                break
+            block_id = self.id_map[candidates[i]]
+            if block_id is not None:
+                results.append((self.by_id[block_id], float(score)))
+        return results
+
+    def _find_related_binary(self, target_row, query, top_k=3):
+        """大库的两段式检索: 汉明距离粗排，候选行再用 int8 反量化向量精确重排"""
+        self._sync_binary_codes()
+        distances = self._hamming_distances(self.emb_bits[target_row], self.emb_count)
+        # 排除目标块自身
+        distances[target_row] = EMBEDDING_DIM + 1
+        candidates = _top_k(-distances, top_k * RESCORE_FACTOR * BINARY_OVERSAMPLE)
+        return self._rescored_results(query, candidates, top_k)
@@ -0,0 +1,96 @@
+import os
+import json
+import pickle
+import sqlite3
+import threading
+from typing import List
+import numpy as np
+from models import SmartBlock
+
+# 持久化目录 (可用环境变量覆盖)：片段存 SQLite，向量矩阵和 FAISS 索引存旁路文件
+DATA_DIR = os.path.expanduser(os.getenv("SPARK_DATA_DIR", "~/.spark"))
+CODES_FILE = "codes.i8"
+SCALES_FILE = "scales.f32"
+VECTORS_HEADER = "vectors.json"
+INDEX_FILE = "index.faiss"
+
+
+class BlockStore:
+    """SmartBlock 的持久化: 每个片段 pickle 后按 id 存一行，保持写入顺序"""
+
+    def __init__(self, data_dir: str):
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(data_dir, "spark.db"), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blocks (id TEXT PRIMARY KEY, blob BLOB)")
+        self._conn.commit()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    def load_blocks(self) -> List[SmartBlock]:
+        with self._lock:
+            rows = self._conn.execute("SELECT blob FROM blocks ORDER BY rowid").fetchall()
+        return [pickle.loads(row[0]) for row in rows]
+
+    def save_block(self, block: SmartBlock):
+        blob = pickle.dumps(block)
+        with self._lock:
+            # upsert 时保留原 rowid，加载顺序不变
+            self._conn.execute(
+                "INSERT INTO blocks (id, blob) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET blob = excluded.blob",
+                (block.id, blob)
+            )
+            self._conn.commit()
+
+
+class VectorStore:
+    """int8 向量矩阵和每行缩放系数的 memmap 文件。按容量预分配，写满时扩展文件再重新映射；
+    头文件记录维度、容量和有效行数。启动时直接映射，不把整个矩阵读进内存"""
+
+    def __init__(self, data_dir: str, dim: int, capacity: int):
+        os.makedirs(data_dir, exist_ok=True)
+        self.dim = dim
+        self.codes_path = os.path.join(data_dir, CODES_FILE)
+        self.scales_path = os.path.join(data_dir, SCALES_FILE)
+        self.header_path = os.path.join(data_dir, VECTORS_HEADER)
+
+        header = {"dim": dim, "capacity": capacity, "count": 0}
+        if os.path.exists(self.header_path):
+            with open(self.header_path, encoding="utf-8") as f:
+                header = json.load(f)
+            if header["dim"] != dim:
+                raise ValueError(f"向量维度不一致: 文件为 {header['dim']}，当前为 {dim}")
+        self.count = header["count"]
+        self._map(max(header["capacity"], capacity))
+        self._write_header()
+
+    def _map(self, capacity: int):
+        # 文件不够长时用 truncate 补零 (稀疏文件，不会真的写满磁盘)
+        for path, row_bytes in ((self.codes_path, self.dim), (self.scales_path, 4)):
+            with open(path, "ab") as f:
+                if os.path.getsize(path) < capacity * row_bytes:
+                    f.truncate(capacity * row_bytes)
+        self.codes = np.memmap(self.codes_path, dtype=np.int8, mode="r+", shape=(capacity, self.dim))
+        self.scales = np.memmap(self.scales_path, dtype=np.float32, mode="r+", shape=(capacity,))
+        self.capacity = capacity
+
+    def grow(self, capacity: int):
+        self.codes.flush()
+        self.scales.flush()
+        self._map(capacity)
+        self._write_header()
+
+    def commit(self, count: int):
+        """新行写入 memmap 后调用: 先刷数据再更新有效行数，崩溃时最多丢掉未提交的行"""
+        self.codes.flush()
+        self.scales.flush()
+        self.count = count
+        self._write_header()
+
+    def _write_header(self):
+        tmp_path = self.header_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "capacity": self.capacity, "count": self.count}, f)
+        os.replace(tmp_path, self.header_path)